@@ -1,10 +1,15 @@
 #! /usr/bin/env python3
 
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 import ephem
+import functools
 import math
-import pytz
+import numpy as np
+import os
 import svgwrite
+import threading
+from zoneinfo import ZoneInfo
 
 params = {
   'vscale': 30,   # Height of an hour
@@ -27,106 +32,295 @@ params = {
   'filename': 'drawing.svg',
 }
 
-class SunEvents:
-  date = None
-  set = None
-  rise = None
-  antitransit = None
-  civil_twilight_pm = None
-  nautical_twilight_pm = None
-  astro_twilight_pm = None
-  civil_twilight_am = None
-  nautical_twilight_am = None
-  astro_twilight_am = None
-
-def get_set_rise(observer, body, horizon='0', use_center=False):
-  original_horizon = observer.horizon
-  observer.horizon = horizon
-  result = (observer.previous_setting(body, use_center=use_center),
-      observer.next_rising(body, use_center=use_center))
-  observer.horizon = original_horizon
-  return result
+EVENT_KEYS = [
+  'set',
+  'rise',
+  'antitransit',
+  'civil_twilight_pm',
+  'nautical_twilight_pm',
+  'astro_twilight_pm',
+  'civil_twilight_am',
+  'nautical_twilight_am',
+  'astro_twilight_am',
+]
 
-def get_sun_events(observer, start_date, end_date):
-  def localize(*dates):
-    return [d.datetime().replace(tzinfo=pytz.utc).astimezone(tz) for d in dates]
+# Sun events for a range of days are stored in a structured array with one
+# row per day. Each event has its local time, along with its hours since
+# local midnight and day offset from the start date, which are what the
+# drawing code works with.
+EVENT_DTYPE = np.dtype([('date', 'datetime64[s]')]
+    + [(k, 'datetime64[s]') for k in EVENT_KEYS]
+    + [(k + '_hour', np.float64) for k in EVENT_KEYS]
+    + [(k + '_day', np.int64) for k in EVENT_KEYS])
+
+# Dates are rounded to about 8 seconds before being used as cache keys, which
+# is far finer than anything visible in the output.
+DATE_KEY_PRECISION = 4
+
+def _date_key(date):
+  return None if date is None else round(float(date), DATE_KEY_PRECISION)
+
+# PyEphem bodies and observers are mutated by every calculation, so each
+# thread keeps its own rather than sharing module-level instances.
+_thread_state = threading.local()
+
+def _get_body(name):
+  bodies = _thread_state.__dict__.setdefault('bodies', {})
+  if name not in bodies:
+    bodies[name] = getattr(ephem, name)()
+  return bodies[name]
+
+def _get_observer(site, horizon):
+  # Observers are reused for every solve at the same site and horizon, so the
+  # horizon only has to be set once per pass rather than once per day.
+  observers = _thread_state.__dict__.setdefault('observers', {})
+  key = (site, horizon)
+  if key not in observers:
+    observers[key] = make_observer(site)
+    observers[key].horizon = horizon
+  return observers[key]
+
+# An observer's site is everything other than its date and horizon that
+# affects rise/set times, as a tuple of primitives that can be used as a
+# cache key or sent to a worker process.
+def get_site(observer):
+  return (float(observer.lat), float(observer.lon), observer.elevation,
+      observer.pressure, observer.temp)
+
+def make_observer(site):
+  observer = ephem.Observer()
+  observer.lat, observer.lon, observer.elevation, observer.pressure, \
+      observer.temp = site
+  return observer
+
+# Bodies are keyed by identity, so a body whose position is changed after
+# being solved for will keep returning the cached results.
+@functools.lru_cache(maxsize=4096)
+def _cached_set_rise(body, site, date, horizon, use_center, set_start,
+    rise_start):
+  observer = _get_observer(site, horizon)
+  observer.date = date
+  return (
+      float(observer.previous_setting(body, start=set_start,
+        use_center=use_center)),
+      float(observer.next_rising(body, start=rise_start,
+        use_center=use_center)))
+
+def get_set_rise(observer, body, horizon='0', use_center=False, seed=None):
+  # If given, seed is a (set, rise) pair for a lower horizon, which usually
+  # brackets this horizon's events and so gives the solver a closer place to
+  # start. When dusk at the lower horizon falls after midnight, though, its
+  # previous setting is from the night before, so the set side is only used
+  # if it's from the same evening.
+  set_start, rise_start = (None, None) if seed is None else seed
+  if set_start is not None and set_start <= observer.date - 0.5:
+    set_start = None
+  result = _cached_set_rise(body, get_site(observer),
+      _date_key(observer.date), horizon, use_center, _date_key(set_start),
+      _date_key(rise_start))
+  return tuple(ephem.Date(d) for d in result)
+
+# PyEphem dates count days from noon UTC on 31 December 1899.
+EPHEM_EPOCH = np.datetime64('1899-12-31T12:00:00', 'us')
+
+def ephem_to_datetime64(dates):
+  microseconds = np.round(np.asarray(dates) * 86400e6)
+  return EPHEM_EPOCH + microseconds.astype('timedelta64[us]')
+
+def _utc_offset(tz, utc_time):
+  return np.timedelta64(utc_time.item().replace(tzinfo=timezone.utc)
+      .astimezone(tz).utcoffset())
+
+def localize(utc_times, tz):
+  # Converts an array of UTC times to local wall-clock times in one pass, by
+  # looking up each time in a table of UTC offset transitions. zoneinfo
+  # doesn't expose its own table, so the part covering these times is rebuilt
+  # by probing the offset once a day and bisecting each day where it changes
+  # down to the second.
+  if utc_times.size == 0:
+    return utc_times
+  one_day = np.timedelta64(1, 'D')
+  one_second = np.timedelta64(1, 's')
+  start = utc_times.min().astype('datetime64[s]')
+  end = utc_times.max().astype('datetime64[s]')
+  probes = np.arange(start, end + one_day, one_day)
+  probe_offsets = [_utc_offset(tz, t) for t in probes]
+  transitions = [start]
+  offsets = [probe_offsets[0]]
+  for i in range(1, len(probes)):
+    if probe_offsets[i] != probe_offsets[i - 1]:
+      before, after = probes[i - 1], probes[i]
+      while after - before > one_second:
+        middle = before + (after - before) // 2
+        if _utc_offset(tz, middle) == probe_offsets[i - 1]:
+          before = middle
+        else:
+          after = middle
+      transitions.append(after)
+      offsets.append(probe_offsets[i])
+  index = np.searchsorted(np.array(transitions), utc_times, side='right') - 1
+  return utc_times + np.array(offsets).astype('timedelta64[us]')[index]
+
+# PyEphem's trick for calculating the various twilights is to lower the
+# horizon to the required angle, and then calculate the rise/set time.
+# The other quirk is that regular rise/set times measure from the sun's
+# upper limb, whereas twilight measures from the centre.
+# Working upwards from the lowest horizon, each pair of events is used as the
+# search start for the next horizon, which it brackets unless dusk at the
+# lower horizon falls after midnight (see get_set_rise).
+HORIZONS = [
+  ('-18', True, 'astro_twilight_pm', 'astro_twilight_am'),
+  ('-12', True, 'nautical_twilight_pm', 'nautical_twilight_am'),
+  ('-6', True, 'civil_twilight_pm', 'civil_twilight_am'),
+  ('0', False, 'set', 'rise'),
+]
+
+def _compute_days(site, dates):
+  # Calculates the raw event times for the days starting at the given dates,
+  # as an array with columns in EVENT_KEYS order. Only takes primitives, so it
+  # can run in a worker process.
+  observer = make_observer(site)
+  sun = _get_body('Sun')
+  events = {}
 
-  sun = ephem.Sun()
+  # Solar midnight falls within 12 hours of clock midnight, so the first
+  # antitransit after noon of the previous day is the nearer one.
+  events['antitransit'] = [
+      observer.next_antitransit(sun, start=ephem.Date(d - 0.5)) for d in dates]
+
+  # Each horizon is done as a separate pass over all the days, seeded with the
+  # results of the pass below it.
+  seeds = [None] * len(dates)
+  for horizon, use_center, set_key, rise_key in HORIZONS:
+    results = np.empty((len(dates), 2))
+    for i, date in enumerate(dates):
+      observer.date = date
+      results[i] = get_set_rise(observer, sun, horizon, use_center, seeds[i])
+    events[set_key], events[rise_key] = results.T
+    seeds = results
+
+  return np.column_stack([events[k] for k in EVENT_KEYS])
+
+DAYS_PER_CHUNK = 32
+
+# Each day's raw event times are kept in the parent process, keyed on site
+# and date, since the caches in worker processes go away with the pool.
+# Repeated calls only compute the days they haven't seen before.
+DAY_CACHE_SIZE = 4096
+_day_cache = {}
+
+def _compute_all_days(site, dates):
+  # Spreading days across worker processes only pays off when there's more
+  # than one CPU and more than one chunk to hand out; otherwise the pool's
+  # start-up and pickling costs make it slower than working in-process.
+  chunks = [dates[i:i + DAYS_PER_CHUNK]
+      for i in range(0, len(dates), DAYS_PER_CHUNK)]
+  if (os.cpu_count() or 1) == 1 or len(chunks) == 1:
+    return np.concatenate([_compute_days(site, c) for c in chunks])
+  with ProcessPoolExecutor() as executor:
+    return np.concatenate(list(executor.map(_compute_days,
+        [site] * len(chunks), chunks)))
+
+def get_sun_events(observer, start_date, end_date):
   tz = start_date.tzinfo
   current_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
-  current_date = current_date.astimezone(pytz.utc)
+  current_date = current_date.astimezone(timezone.utc)
   one_day = timedelta(days=1)
-  result = []
-  while current_date < end_date:
-    observer.date = ephem.Date(current_date)
-    events = SunEvents()
-    events.date = current_date
-    events.set, events.rise = localize(*get_set_rise(observer, sun))
-
-    # We don't know in advance whether solar midnight will fall before or after
-    # clock midnight, so calculate both and take the nearer one.
-    events.antitransit, = localize(min(
-        observer.previous_antitransit(sun),
-        observer.next_antitransit(sun),
-        key = lambda x: abs((current_date -
-          x.datetime().replace(tzinfo=pytz.utc)).total_seconds())))
-
-    # PyEphem's trick for calculating the various twilights is to lower the
-    # horizon to the required angle, and then calculate the rise/set time.
-    # The other quirk is that regular rise/set times measure from the sun's
-    # upper limb, whereas twilight measures from the centre.
-    events.civil_twilight_pm, events.civil_twilight_am = localize(
-        *get_set_rise(observer, sun, horizon='-6', use_center=True))
-    events.nautical_twilight_pm, events.nautical_twilight_am = localize(
-        *get_set_rise(observer, sun, horizon='-12', use_center=True))
-    events.astro_twilight_pm, events.astro_twilight_am = localize(
-        *get_set_rise(observer, sun, horizon='-18', use_center=True))
-
-    result.append(events)
-    current_date += one_day
-  return result
+  n_days = math.ceil((end_date - current_date) / one_day)
+  if n_days <= 0:
+    return np.empty(0, dtype=EVENT_DTYPE)
+  # PyEphem dates are plain day counts, so the whole range can be laid out
+  # without converting each day's datetime separately.
+  ephem_dates = float(ephem.Date(current_date)) + np.arange(n_days,
+      dtype=np.float64)
+
+  site = get_site(observer)
+  keys = [(site, _date_key(d)) for d in ephem_dates]
+  missing = [i for i, k in enumerate(keys) if k not in _day_cache]
+  raw = np.empty((n_days, len(EVENT_KEYS)))
+  if missing:
+    raw[missing] = _compute_all_days(site, ephem_dates[missing])
+  for i, k in enumerate(keys):
+    if k in _day_cache:
+      raw[i] = _day_cache[k]
+    else:
+      _day_cache[k] = raw[i].copy()
+  while len(_day_cache) > DAY_CACHE_SIZE:
+    del _day_cache[next(iter(_day_cache))]
+
+  local = localize(ephem_to_datetime64(raw), tz).astype('datetime64[s]')
+  local_days = local.astype('datetime64[D]')
+  events = np.empty(n_days, dtype=EVENT_DTYPE)
+  events['date'] = ephem_to_datetime64(ephem_dates)
+  for i, k in enumerate(EVENT_KEYS):
+    events[k] = local[:, i]
+    events[k + '_hour'] = (local[:, i] - local_days[:, i]) \
+        / np.timedelta64(1, 'h')
+    events[k + '_day'] = (local_days[:, i]
+        - np.datetime64(start_date.date())).astype(np.int64)
+  return events
 
 calc_params = {}
 
-def hours_since_midnight(date):
-  return date.hour + date.minute/60 + date.second/3600
-
-def date_to_point(date):
-  day_diff = (date - params['start-date']).days
-  time_diff = calc_params['latest-rise'] - hours_since_midnight(date)
-  if date.hour >= 12:
-    day_diff += 1
-    time_diff += 24
-  x = day_diff * params['hscale'] + params['padding-left']
-  y = time_diff * params['vscale'] + params['padding-top']
-  return x, y
-
-def get_sun_event_path(events, key1, key2):
-  path = svgwrite.path.Path()
-  path.push('M ')
-  for e in events:
-    path.push('%.2f %.2f ' % date_to_point(key1(e)))
-  for e in reversed(events):
-    path.push('%.2f %.2f ' % date_to_point(key2(e)))
-  path.push('z')
-  return path
+def make_path_projection(latest_rise, hscale, vscale, pad_left, pad_top):
+  # The layout is fixed for a whole run, so its constants are folded into a
+  # projection from (day offset, hours) to canvas coordinates once, up front.
+  y_origin = latest_rise * vscale + pad_top
+  night_shift = 24 * vscale
+
+  def project(day_diff, hours):
+    # Events after noon are drawn as part of the following night, so they
+    # move on by a day and down by 24 hours.
+    after_noon = hours >= 12
+    coords = np.empty(hours.shape + (2,))
+    coords[..., 0] = (day_diff + after_noon) * hscale + pad_left
+    coords[..., 1] = y_origin - hours * vscale + after_noon * night_shift
+    return coords
+
+  return project
+
+# Each shaded region is bounded by a morning event going forward in time and
+# the matching evening event coming back.
+PATH_BOUNDS = {
+  'civil': ('rise', 'set'),
+  'nautical': ('civil_twilight_am', 'civil_twilight_pm'),
+  'astro': ('nautical_twilight_am', 'nautical_twilight_pm'),
+  'night': ('astro_twilight_am', 'astro_twilight_pm'),
+}
+
+def build_all_paths(events):
+  # Builds the outlines of every region in one pass, by stacking their
+  # boundary columns into a single (region, point) array.
+  def columns(suffix):
+    am = np.stack([events[k[0] + suffix] for k in PATH_BOUNDS.values()])
+    pm = np.stack([events[k[1] + suffix] for k in PATH_BOUNDS.values()])
+    return np.concatenate([am, pm[:, ::-1]], axis=1)
+
+  day_diff = columns('_day')
+  hours = columns('_hour')
+  project = make_path_projection(calc_params['latest-rise'],
+      params['hscale'], params['vscale'], params['padding-left'],
+      params['padding-top'])
+  coords = project(day_diff, hours)
+  # Format every coordinate with one call per path rather than one per point.
+  template = 'M ' + ' '.join(['%.2f'] * coords[0].size) + ' z'
+  return {name: template % tuple(c.ravel().tolist())
+      for name, c in zip(PATH_BOUNDS, coords)}
 
 def main():
   observer = ephem.Observer()
   observer.lat = params['latitude']
   observer.lon = params['longitude']
-  timezone = pytz.timezone(params['timezone'])
-  params['start-date'] = params['start-date'].replace(tzinfo=timezone)
-  params['end-date'] = params['end-date'].replace(tzinfo=timezone)
+  tz = ZoneInfo(params['timezone'])
+  params['start-date'] = params['start-date'].replace(tzinfo=tz)
+  params['end-date'] = params['end-date'].replace(tzinfo=tz)
 
   sun_events = get_sun_events(observer,
       params['start-date'], params['end-date'])
 
   # Calculate data-dependent layout parameters
-  temp = min(sun_events, key = lambda x: x.set.time()).set
-  calc_params['earliest-set'] = 24 - hours_since_midnight(temp)
-  temp = max(sun_events, key = lambda x: x.rise.time()).rise
-  calc_params['latest-rise'] = hours_since_midnight(temp)
+  calc_params['earliest-set'] = 24 - float(sun_events['set_hour'].min())
+  calc_params['latest-rise'] = float(sun_events['rise_hour'].max())
   calc_params['canvas-width'] = \
       (params['end-date'] - params['start-date']).days * params['hscale'] \
       + params['padding-left'] + params['padding-right']
@@ -138,38 +332,14 @@ def main():
       size=(calc_params['canvas-width'], calc_params['canvas-height']))
 
   # Add a border and background for debug purposes
-  border = svgwrite.path.Path()
-  border.push('M 0 0 %d 0 %d %d 0 %d Z' % (calc_params['canvas-width'],
-    calc_params['canvas-width'], calc_params['canvas-height'],
-    calc_params['canvas-height']))
-  border.attribs['fill'] = params['day-fill']
-  border.attribs['stroke'] = 'black'
-  border.attribs['stroke-width'] = '4'
-  drawing.add(border)
-
-  # Draw civil twilight path
-  civil_twilight_path = get_sun_event_path(sun_events,
-      lambda x: x.rise, lambda x: x.set)
-  civil_twilight_path.attribs['fill'] = params['civil-fill']
-  drawing.add(civil_twilight_path)
-
-  # Draw nautical twilight path
-  nautical_twilight_path = get_sun_event_path(sun_events,
-      lambda x: x.civil_twilight_am, lambda x: x.civil_twilight_pm)
-  nautical_twilight_path.attribs['fill'] = params['nautical-fill']
-  drawing.add(nautical_twilight_path)
-
-  # Draw astronomical twilight path
-  astro_twilight_path = get_sun_event_path(sun_events,
-      lambda x: x.nautical_twilight_am, lambda x: x.nautical_twilight_pm)
-  astro_twilight_path.attribs['fill'] = params['astro-fill']
-  drawing.add(astro_twilight_path)
-
-  # Draw night path
-  night_path = get_sun_event_path(sun_events,
-      lambda x: x.astro_twilight_am, lambda x: x.astro_twilight_pm)
-  night_path.attribs['fill'] = params['night-fill']
-  drawing.add(night_path)
+  width = int(calc_params['canvas-width'])
+  height = int(calc_params['canvas-height'])
+  drawing.add(drawing.path(d=f'M 0 0 {width} 0 {width} {height} 0 {height} Z',
+      fill=params['day-fill'], stroke='black', stroke_width='4'))
+
+  # Draw twilight and night paths
+  for name, d in build_all_paths(sun_events).items():
+    drawing.add(drawing.path(d=d, fill=params[name + '-fill']))
 
   drawing.save()
 